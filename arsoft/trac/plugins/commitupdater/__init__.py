@@ -3,4 +3,4 @@
 # kate: space-indent on; indent-width 4; mixedindent off; indent-mode python;
 
 __version__ = __import__('pkg_resources').get_distribution('arsoft-trac-commitupdater').version
-from commit_updater import *
+from .commit_updater import *
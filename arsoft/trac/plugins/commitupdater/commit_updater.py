@@ -37,11 +37,10 @@
 # IN THE SOFTWARE.
 # ----------------------------------------------------------------------------
 
-from __future__ import with_statement
-
 import re
-import textwrap
+from collections import OrderedDict
 
+from trac.cache import cached
 from trac.config import BoolOption, Option
 from trac.core import Component, implements
 from trac.notification.api import NotificationSystem
@@ -49,6 +48,7 @@ from trac.perm import PermissionCache
 from trac.resource import Resource, ResourceNotFound
 from trac.ticket import Ticket
 from trac.ticket.notification import TicketChangeEvent
+from trac.util import lazy
 from trac.util.datefmt import datetime_now, utc
 from trac.util.html import tag
 from trac.util.text import exception_to_unicode
@@ -58,6 +58,11 @@ from trac.versioncontrol.web_ui.changeset import ChangesetModule
 from trac.wiki.formatter import format_to_html
 from trac.wiki.macros import WikiMacroBase
 
+# All patterns below only deal with ASCII characters; match them with
+# ASCII semantics on Python 3 as well (re.ASCII does not exist on Python 2,
+# where this is the default for str patterns).
+_re_flags = getattr(re, 'ASCII', 0)
+
 
 class CommitTicketUpdater(Component):
     """Update tickets based on commit messages.
@@ -194,25 +199,115 @@ class CommitTicketUpdater(Component):
         """Send ticket change notification when updating a ticket.""")
 
     ticket_prefix = '(?:#|(?:ticket|issue|bug)[: ]?)'
+    # Literals of which at least one must occur in a ticket reference
+    ticket_markers = ('#', 'ticket', 'issue', 'bug')
     ticket_reference = ticket_prefix + \
                        '[0-9]+(?:#comment:([0-9]+|description))?'
-    ticket_command = (r'(?P<action>[A-Za-z\_]*)\s*.?\s*'
-                      r'(?P<ticket>%s(?:(?:[, &]*|[ ]?and[ ]?)%s)*)' %
-                      (ticket_reference, ticket_reference))
+    # The id of the first reference is captured as well, so that commands
+    # referencing a single ticket don't need a second scan.
+    ticket_list = (r'(?P<ticket>%s(?P<tkt_id>[0-9]+)'
+                   r'(?:#comment:(?:[0-9]+|description))?'
+                   r'(?P<more>(?:(?:[, &]*|[ ]?and[ ]?)%s)*))' %
+                   (ticket_prefix, ticket_reference))
+    ticket_command = r'(?P<action>[A-Za-z\_]*)\s*.?\s*' + ticket_list
 
     @property
     def command_re(self):
-        (begin, end) = (re.escape(self.envelope[0:1]),
-                        re.escape(self.envelope[1:2]))
-        return re.compile(begin + self.ticket_command + end)
-
-    ticket_re = re.compile(ticket_prefix + '([0-9]+)')
+        return self._get_command_re(self._get_functions(), self.envelope)
+
+    def _get_command_re(self, functions, envelope):
+        # The pattern depends on the envelope and the commands options, so
+        # it is only rebuilt when one of their values has changed.
+        key = (envelope, self._functions_key)
+        if key != self._command_re_key:
+            if self._default_function:
+                command = self.ticket_command
+            else:
+                command = self._make_action_pattern(functions) + \
+                          r'\s*.?\s*' + self.ticket_list
+            if envelope:
+                command = re.escape(envelope[0:1]) + command + \
+                          re.escape(envelope[1:2])
+            self._command_re = re.compile(command, _re_flags)
+            self._command_re_key = key
+        return self._command_re
 
+    @staticmethod
+    def _make_action_pattern(commands):
+        """Build a pattern matching any of the given commands as a whole
+        word or directly followed by a ticket reference, ignoring case."""
+        if not commands:
+            return '(?!)'
+        # Commands sharing a prefix like 'close', 'closed' and 'closes' are
+        # merged into a trie, so that the regex engine does not test the
+        # common prefix again for each of them.
+        trie = {}
+        for cmd in commands:
+            node = trie
+            for c in cmd:
+                node = node.setdefault(c, {})
+            node[''] = None
+
+        def make_pattern(node):
+            alternatives = []
+            for c in sorted(node):
+                if c:
+                    char = '[%s%s]' % (c.upper(), c) if c.isalpha() \
+                           else re.escape(c)
+                    alternatives.append(char + make_pattern(node[c]))
+            if not alternatives:
+                return ''
+            if len(alternatives) == 1 and '' not in node:
+                return alternatives[0]
+            return '(?:%s)%s' % ('|'.join(alternatives),
+                                 '?' if '' in node else '')
+
+        # A command directly followed by more letters is only matched if no
+        # longer word in front of the ticket reference would be taken as
+        # the action instead, as in 'Fixesticket:1'.
+        return r'(?<![A-Za-z\_])(?P<action>%s)' \
+               r'(?![A-Za-z\_]+\s*.?\s*%s[0-9])' % \
+               (make_pattern(trie), CommitTicketUpdater.ticket_prefix)
+
+    ticket_re = re.compile(ticket_prefix + '([0-9]+)', _re_flags)
+
+    author_re = re.compile(r'(?:(?P<name>[^@]*)<)?'
+                           r'(?P<email>[^@]*@(?P<domain>[^>]*))')
+
+    comment_template = """\
+In [changeset:"%s%s" %s%s]:
+{{{
+#!CommitTicketReference repository="%s" revision="%s"
+%s
+}}}"""
+
+    # Suffixes of the cmd_* methods and their commands_* options
+    _command_names = ('close', 'refs', 'reopens', 'implements', 'rejects',
+                      'invalidate', 'worksforme', 'alreadyimplemented',
+                      'testready')
+
+    _command_re = None
+    _command_re_key = None
+    _allowed_domains = None
+    _allowed_domains_key = None
+    _default_function = None
+    _functions = None
+    _functions_key = None
+    _last_author = None
     _last_cset_id = None
+    _user_index = None
+    _user_index_source = None
 
 
-    def changeset_added_impl(self, repos, changeset):
-        tickets = self._parse_message(changeset.message)
+    def changeset_added_impl(self, repos, changeset, tickets=None):
+        """Update the tickets referenced by the changeset.
+
+        The result of `_parse_message` can be passed as `tickets` if the
+        message has already been parsed."""
+        if tickets is None:
+            tickets = self._parse_message(changeset.message)
+        if not tickets:
+            return {}
         comment = self.make_ticket_comment(repos, changeset)
         return self._update_tickets(tickets, changeset, comment,
                              datetime_now(utc))
@@ -230,40 +325,47 @@ class CommitTicketUpdater(Component):
         self.log.debug("changeset_modified on %s for changesets %s", repos.name, changeset.rev)
         if self._is_duplicate(changeset):
             return
+        if old_changeset is not None and \
+                old_changeset.message == changeset.message:
+            return
         tickets = self._parse_message(changeset.message)
-        old_tickets = {}
-        if old_changeset is not None:
-            old_tickets = self._parse_message(old_changeset.message)
-        tickets = dict(each for each in tickets.iteritems()
-                       if each[0] not in old_tickets)
+        if old_changeset is not None and tickets:
+            for tkt_id in self._parse_message(old_changeset.message):
+                tickets.pop(tkt_id, None)
+        if not tickets:
+            return
         comment = self.make_ticket_comment(repos, changeset)
         self._update_tickets(tickets, changeset, comment,
                              datetime_now(utc))
 
     @staticmethod
     def _get_changeset_author(changeset_author):
-        author_name = None
-        author_email = None
-        author_email_domain = None
-        at_idx = changeset_author.find('@')
-        if at_idx > 0:
-            start_idx = changeset_author.rfind('<', 0, at_idx)
-            if start_idx < 0:
-                start_idx = 0
-            else:
-                author_name = changeset_author[0:start_idx].strip()
-                start_idx = start_idx + 1
-            end_idx = changeset_author.find('>', at_idx)
-            if end_idx < 0:
-                end_idx = len(changeset_author)
-            author_email = changeset_author[start_idx:end_idx]
-            author_email_domain = changeset_author[at_idx+1:end_idx].lower()
+        # The mail address starts after the last '<' in front of the first
+        # '@' (or at the beginning) and ends at the next '>'.
+        m = CommitTicketUpdater.author_re.match(changeset_author)
+        if m is None or m.start('domain') < 2:
+            return None, None, None
+        author_name = m.group('name')
+        if author_name is not None:
+            author_name = author_name.strip()
+        author_email = m.group('email')
+        author_email_domain = m.group('domain').lower()
 
         return author_name, author_email, author_email_domain
 
+    def _get_allowed_domains(self):
+        """Return the allowed domains as a set, parsing the option only
+        when its value has changed."""
+        allowed_domains = self.allowed_domains
+        if allowed_domains != self._allowed_domains_key:
+            self._allowed_domains = frozenset(allowed_domains.lower().split())
+            self._allowed_domains_key = allowed_domains
+        return self._allowed_domains
+
     def _is_author_allowed(self, changeset_author):
         #self.log.info('_is_author_allowed got %s, cfg %s' % (changeset_author, self.allowed_domains))
-        if not self.allowed_domains:
+        allowed_domains = self._get_allowed_domains()
+        if not allowed_domains:
             ret = True
         else:
             # Default to deny author when we are unable to get a valid email from the
@@ -271,30 +373,54 @@ class CommitTicketUpdater(Component):
             ret = False
             author_name, author_email, author_email_domain = CommitTicketUpdater._get_changeset_author(changeset_author)
             if author_email_domain is not None:
-                allowed_domains_list = self.allowed_domains.split(' ')
-                ret = True if author_email_domain in allowed_domains_list else False
+                ret = author_email_domain in allowed_domains
         return ret
 
+    def _get_user_index(self):
+        """Return a mapping from lowercased email addresses and user names
+        to user names.
+
+        The index is rebuilt whenever Trac's own cache of the known users
+        has been invalidated. As in a linear search ordered by user name,
+        the first user with a matching email or name wins."""
+        known_users = self.env.get_known_users(as_dict=True)
+        if known_users is not self._user_index_source:
+            index = {}
+            for username, (name, email) in sorted(known_users.items()):
+                if email is not None:
+                    index.setdefault(email.lower(), username)
+                index.setdefault(username.lower(), username)
+            self._user_index = index
+            self._user_index_source = known_users
+        return self._user_index
+
     def _get_username_for_email(self, changeset_email):
-        changeset_email_lower = changeset_email.lower()
-        for username, name, email in self.env.get_known_users():
-            #print('%s, %s, %s <> %s' % (username, name, email, changeset_email_lower))
-            if (email is not None and email.lower() == changeset_email_lower) or (username is not None and username.lower() == changeset_email_lower):
-                return username
-        return None
+        return self._get_user_index().get(changeset_email.lower())
 
     def _get_username_for_changeset_author(self, changeset_author):
+        # The commands ask for the author of the same changeset again for
+        # every ticket, so remember the last result as long as the user
+        # index is unchanged.
+        user_index = self._get_user_index()
+        last_author = self._last_author
+        if last_author is not None and last_author[0] == changeset_author \
+                and last_author[1] is user_index:
+            return last_author[2]
         author_name, author_email, author_email_domain = CommitTicketUpdater._get_changeset_author(changeset_author)
         #print(author_name, author_email, author_email_domain )
         if author_email is not None:
-            return self._get_username_for_email(author_email)
+            username = self._get_username_for_email(author_email)
         else:
-            return self._get_username_for_email(changeset_author)
+            username = self._get_username_for_email(changeset_author)
+        self._last_author = (changeset_author, user_index, username)
+        return username
 
     def _is_duplicate(self, changeset):
-        # Avoid duplicate changes with multiple scoped repositories
-        cset_id = (changeset.rev, changeset.message, changeset.author,
-                   changeset.date)
+        # Avoid duplicate changes with multiple scoped repositories. Only the
+        # hash of the message is kept, so an edited message is not mistaken
+        # for a duplicate while the previous message can still be released.
+        cset_id = (changeset.rev, changeset.author, changeset.date,
+                   hash(changeset.message))
         if cset_id != self._last_cset_id:
             self._last_cset_id = cset_id
             return False
@@ -302,47 +428,72 @@ class CommitTicketUpdater(Component):
 
     def _parse_message(self, message):
         """Parse the commit message and return the ticket references."""
-        cmd_groups = self.command_re.finditer(message)
+        for marker in self.ticket_markers:
+            if marker in message:
+                break
+        else:
+            return {}
+        envelope = self.envelope
+        if envelope and envelope[0] not in message:
+            return {}
         functions = self._get_functions()
+        cmd_groups = self._get_command_re(functions, envelope).finditer(message)
+        # Unless all references are accepted, command_re only matches the
+        # configured commands, so every action has a function.
+        default = self._default_function
+        # The scanning itself is done by the regex engine; the loop below
+        # only runs once per command found. Bulk imports parse many
+        # messages, so look up the methods used in the loop only once.
+        get_function = functions.get
+        find_tickets = self.ticket_re.findall
+        to_int = int
         tickets = {}
         for m in cmd_groups:
-            cmd, tkts = m.group('action', 'ticket')
-            func = functions.get(cmd.lower())
-            if not func and self.commands_refs.strip() == '<ALL>':
-                func = self.cmd_refs
+            func = get_function(m.group('action').lower(), default)
             if func:
-                for tkt_id in self.ticket_re.findall(tkts):
-                    tickets.setdefault(int(tkt_id), []).append(func)
+                if not m.group('more'):
+                    tkt_ids = (m.group('tkt_id'),)
+                else:
+                    # Scan only the span of the ticket group within the
+                    # message instead of copying it out first.
+                    start, end = m.span('ticket')
+                    tkt_ids = find_tickets(message, start, end)
+                for tkt_id in tkt_ids:
+                    # Run each command only once per ticket, keeping the
+                    # order in which the commands appear in the message.
+                    funcs = tickets.setdefault(to_int(tkt_id), [])
+                    if func not in funcs:
+                        funcs.append(func)
         return tickets
 
     def make_ticket_comment(self, repos, changeset):
         """Create the ticket comment from the changeset data."""
         rev = changeset.rev
-        revstring = str(rev)
-        drev = str(repos.display_rev(rev))
-        if repos.reponame:
-            revstring += '/' + repos.reponame
-            drev += '/' + repos.reponame
-        return textwrap.dedent("""\
-In [changeset:"%s" %s]:
-{{{
-#!CommitTicketReference repository="%s" revision="%s"
-%s
-}}}""") % (revstring, drev, repos.reponame, rev,
-                       changeset.message.strip())
+        reponame = repos.reponame
+        suffix = '/' + reponame if reponame else ''
+        return self.comment_template % (rev, suffix, repos.display_rev(rev),
+                                        suffix, reponame, rev,
+                                        changeset.message.strip())
 
     def _update_tickets(self, tickets, changeset, comment, date):
         """Update the tickets with the given comment."""
-
+        if not tickets:
+            return {}
         authname = self._get_username_for_changeset_author(changeset.author)
         if not authname:
             authname = self._authname(changeset)
         perm = PermissionCache(self.env, authname)
+        check_perms = self.check_perms
+        # The author check only depends on the changeset
+        author_allowed = self._is_author_allowed(changeset.author)
         ret = {}
-        for tkt_id, cmds in tickets.iteritems():
-            self.log.debug("Updating ticket #%d", tkt_id)
-            save = False
-            with self.env.db_transaction:
+        saved = []
+        # Update all tickets in a single transaction and only send the
+        # notifications once it has been committed.
+        with self.env.db_transaction:
+            for tkt_id, cmds in tickets.items():
+                self.log.debug("Updating ticket #%d", tkt_id)
+                save = False
                 try:
                     ticket = Ticket(self.env, tkt_id)
                 except ResourceNotFound:
@@ -350,30 +501,29 @@ In [changeset:"%s" %s]:
                     ticket = None
                 if ticket is not None:
                     ticket_perm = perm(ticket.resource)
-                    if self.check_perms and not 'TICKET_MODIFY' in ticket_perm:
+                    if check_perms and not 'TICKET_MODIFY' in ticket_perm:
                         #sys.stderr.write("%s doesn't have TICKET_MODIFY permission for #%d\n" % (authname, ticket.id))
                         self.log.info("%s doesn't have TICKET_MODIFY permission for #%d",
                                     authname, ticket.id)
+                    elif not author_allowed:
+                        #sys.stderr.write("%s is not allowed to modify to #%d\n" % (changeset.author, ticket.id))
+                        self.log.info("%s is not allowed to modify to #%d",
+                                    changeset.author, ticket.id)
                     else:
-                        if self._is_author_allowed(changeset.author):
-                            for cmd in cmds:
-                                if cmd(ticket, changeset, ticket_perm):
-                                    save = True
-                        else:
-                            #sys.stderr.write("%s is not allowed to modify to #%d\n" % (changeset.author, ticket.id))
-                            self.log.info("%s is not allowed to modify to #%d",
-                                        changeset.author, ticket.id)
+                        for cmd in cmds:
+                            if cmd(ticket, changeset, ticket_perm):
+                                save = True
                     if save:
                         ticket.save_changes(authname, comment, date)
-            if save:
-                self._notify(ticket, date)
-            ret[tkt_id] = (cmds, ticket)
+                        saved.append(ticket)
+                ret[tkt_id] = (cmds, ticket)
+        if saved and self.notify:
+            for ticket in saved:
+                self._notify(ticket, date, authname, comment)
         return ret
 
     def _notify(self, ticket, date, author, comment):
         """Send a ticket update notification."""
-        if not self.notify:
-            return
         event = TicketChangeEvent('changed', ticket, date, author, comment)
         try:
             NotificationSystem(self.env).notify(event)
@@ -383,72 +533,77 @@ In [changeset:"%s" %s]:
                            exception_to_unicode(e))
 
     def _get_functions(self):
-        """Create a mapping from commands to command functions."""
-        functions = {}
-        for each in dir(self):
-            if not each.startswith('cmd_'):
-                continue
-            func = getattr(self, each)
-            for cmd in getattr(self, 'commands_' + each[4:], '').split():
-                functions[cmd] = func
-        return functions
+        """Create a mapping from commands to command functions.
+
+        The mapping is cached and the option values are only split again
+        when one of the `commands_*` options has changed. If `commands.refs`
+        is set to `<ALL>`, `cmd_refs` also becomes the `_default_function`
+        for any other action."""
+        key = tuple(getattr(self, 'commands_' + name)
+                    for name in self._command_names)
+        if key != self._functions_key:
+            functions = {}
+            for name, commands in zip(self._command_names, key):
+                func = getattr(self, 'cmd_' + name)
+                for cmd in commands.split():
+                    functions[cmd.lower()] = func
+            self._functions = functions
+            self._default_function = self.cmd_refs \
+                if self.commands_refs.strip() == '<ALL>' else None
+            self._functions_key = key
+        return self._functions
+
+    @lazy
+    def _ignore_auth_case(self):
+        # The environment, and with it this component, is reloaded when
+        # trac.ini changes, so the option only needs to be read once.
+        return self.env.config.getbool('trac', 'ignore_auth_case')
 
     def _authname(self, changeset):
         """Returns the author of the changeset, normalizing the casing if
-        [trac] ignore_author_case is true."""
+        [trac] ignore_auth_case is true."""
         return changeset.author.lower() \
-               if self.env.config.getbool('trac', 'ignore_auth_case') \
-               else changeset.author
+               if self._ignore_auth_case else changeset.author
 
     # Command-specific behavior
     # The ticket isn't updated if all extracted commands return False.
 
-    def cmd_close(self, ticket, changeset, perm):
+    def _assign_to_author(self, ticket, changeset):
+        """Assign the ticket to the changeset author, if the author is a
+        known user."""
+        author_username = self._get_username_for_changeset_author(changeset.author)
+        if author_username:
+            ticket['owner'] = author_username
+
+    def _close_ticket(self, ticket, changeset, resolution, reassign=False):
+        """Close the ticket with the given resolution.
+
+        The ticket is assigned to the changeset author if `reassign` is
+        true or if it has no owner yet."""
         if ticket['status'] != 'closed':
             ticket['status'] = 'closed'
-            ticket['resolution'] = 'fixed'
-            author_username = self._get_username_for_changeset_author(changeset.author)
-            if author_username:
-                ticket['owner'] = author_username
+            ticket['resolution'] = resolution
+            if reassign or not ticket['owner']:
+                self._assign_to_author(ticket, changeset)
         return True
 
+    def cmd_close(self, ticket, changeset, perm):
+        return self._close_ticket(ticket, changeset, 'fixed', reassign=True)
+
     def cmd_invalidate(self, ticket, changeset, perm):
-        if ticket['status'] != 'closed':
-            ticket['status'] = 'closed'
-            ticket['resolution'] = 'invalid'
-            if not ticket['owner']:
-                author_username = self._get_username_for_changeset_author(changeset.author)
-                if author_username:
-                    ticket['owner'] = author_username
-        return True
+        return self._close_ticket(ticket, changeset, 'invalid')
 
     def cmd_worksforme(self, ticket, changeset, perm):
-        if ticket['status'] != 'closed':
-            ticket['status'] = 'closed'
-            ticket['resolution'] = 'worksforme'
-            if not ticket['owner']:
-                author_username = self._get_username_for_changeset_author(changeset.author)
-                if author_username:
-                    ticket['owner'] = author_username
-        return True
+        return self._close_ticket(ticket, changeset, 'worksforme')
 
     def cmd_alreadyimplemented(self, ticket, changeset, perm):
-        if ticket['status'] != 'closed':
-            ticket['status'] = 'closed'
-            ticket['resolution'] = 'already_implemented'
-            if not ticket['owner']:
-                author_username = self._get_username_for_changeset_author(changeset.author)
-                if author_username:
-                    ticket['owner'] = author_username
-        return True
+        return self._close_ticket(ticket, changeset, 'already_implemented')
 
     def cmd_reopens(self, ticket, changeset, perm):
         if ticket['status'] == 'closed':
             ticket['status'] = 'reopened'
             ticket['resolution'] = ''
-            author_username = self._get_username_for_changeset_author(changeset.author)
-            if author_username:
-                ticket['owner'] = author_username
+            self._assign_to_author(ticket, changeset)
         return True
 
     def cmd_refs(self, ticket, changeset, perm):
@@ -457,9 +612,7 @@ In [changeset:"%s" %s]:
     def cmd_implements(self, ticket, changeset, perm):
         if ticket['status'] != 'implemented' and ticket['status'] != 'closed':
             ticket['status'] = 'implemented'
-            author_username = self._get_username_for_changeset_author(changeset.author)
-            if author_username:
-                ticket['owner'] = author_username
+            self._assign_to_author(ticket, changeset)
         return True
 
     def cmd_rejects(self, ticket, changeset, perm):
@@ -468,9 +621,7 @@ In [changeset:"%s" %s]:
             if ticket['reporter']:
                 ticket['owner'] = ticket['reporter']
             if not ticket['owner']:
-                author_username = self._get_username_for_changeset_author(changeset.author)
-                if author_username:
-                    ticket['owner'] = author_username
+                self._assign_to_author(ticket, changeset)
         return True
 
     def cmd_testready(self, ticket, changeset, perm):
@@ -480,9 +631,7 @@ In [changeset:"%s" %s]:
             if ticket['reporter']:
                 ticket['owner'] = ticket['reporter']
             if not ticket['owner']:
-                author_username = self._get_username_for_changeset_author(changeset.author)
-                if author_username:
-                    ticket['owner'] = author_username
+                self._assign_to_author(ticket, changeset)
         return True
 
 class CommitTicketReferenceMacro(WikiMacroBase):
@@ -501,23 +650,79 @@ class CommitTicketReferenceMacro(WikiMacroBase):
      - `revision`: the revision of the desired changeset
     """)
 
+    implements(IRepositoryChangeListener)
+
+    # Maximum number of commit messages whose ticket ids are remembered
+    _ticket_ids_cache_size = 256
+    # Maximum number of changeset messages kept by _get_changeset_message
+    _messages_cache_size = 256
+
+    def __init__(self):
+        self._ticket_ids_cache = OrderedDict()
+
+    def _get_ticket_ids(self, message):
+        """Return the set of ticket ids referenced by the message."""
+        ticket_ids = self._ticket_ids_cache.get(message)
+        if ticket_ids is None:
+            if len(self._ticket_ids_cache) >= self._ticket_ids_cache_size:
+                self._ticket_ids_cache.popitem(last=False)
+            ticket_re = CommitTicketUpdater.ticket_re
+            ticket_ids = frozenset(int(tkt_id)
+                                   for tkt_id in ticket_re.findall(message))
+            self._ticket_ids_cache[message] = ticket_ids
+        return ticket_ids
+
+    @cached
+    def _changeset_messages(self):
+        """Messages and revisions of recently referenced changesets, by
+        repository name and normalized revision."""
+        return OrderedDict()
+
+    def _get_changeset_message(self, repos, rev):
+        """Return the message and normalized revision of a changeset.
+
+        Changesets are cached as fetching them can be expensive, e.g. for
+        git repositories. They are cached by normalized revision, so that
+        symbolic revisions always show the changeset they currently refer
+        to. The cache is invalidated for all processes when a changeset is
+        modified."""
+        if rev is None:
+            changeset = repos.get_changeset(rev)
+            return changeset.message, changeset.rev
+        rev = repos.normalize_rev(rev)
+        messages = self._changeset_messages
+        key = (repos.reponame, rev)
+        entry = messages.get(key)
+        if entry is None:
+            changeset = repos.get_changeset(rev)
+            entry = (changeset.message, changeset.rev)
+            if len(messages) >= self._messages_cache_size:
+                messages.popitem(last=False)
+            messages[key] = entry
+        return entry
+
+    # IRepositoryChangeListener methods
+
+    def changeset_added(self, repos, changeset):
+        pass
+
+    def changeset_modified(self, repos, changeset, old_changeset):
+        del self._changeset_messages
+
     def expand_macro(self, formatter, name, content, args=None):
         args = args or {}
         reponame = args.get('repository') or ''
         rev = args.get('revision')
         repos = RepositoryManager(self.env).get_repository(reponame)
         try:
-            changeset = repos.get_changeset(rev)
-            message = changeset.message
-            rev = changeset.rev
+            message, rev = self._get_changeset_message(repos, rev)
             resource = repos.resource
         except Exception:
             message = content
             resource = Resource('repository', reponame)
         if formatter.context.resource.realm == 'ticket':
-            ticket_re = CommitTicketUpdater.ticket_re
-            if not any(int(tkt_id) == int(formatter.context.resource.id)
-                       for tkt_id in ticket_re.findall(message)):
+            if int(formatter.context.resource.id) not in \
+                    self._get_ticket_ids(message):
                 return tag.p(_("(The changeset message doesn't reference "
                                "this ticket)"), class_='hint')
         if ChangesetModule(self.env).wiki_format_messages:
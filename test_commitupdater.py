@@ -3,27 +3,33 @@
 # kate: space-indent on; indent-width 4; mixedindent off; indent-mode python;
 
 from __future__ import print_function
-import sys
-import os.path
 
 from arsoft.trac.plugins.commitupdater import *
-import trac.env
-import time, unittest
+import unittest
+from collections import namedtuple
+from datetime import datetime, timedelta
 from trac import perm
-from trac.util.datefmt import time_now, utc
-from trac.core import ComponentManager
-from trac.ticket.model import Component
-from trac.ticket import TicketSystem
-from trac.versioncontrol.api import Repository, Changeset, NoSuchChangeset
-from trac.web.session import Session
-from trac.wiki.web_ui import ReadonlyWikiPolicy
-from tracopt.versioncontrol.git.git_fs import GitRepository
-from trac.test import EnvironmentStub, Mock, MockRequest
+from trac.notification.api import NotificationSystem
+from trac.util.datefmt import to_timestamp, utc
+from trac.ticket.model import Component, Resolution
+from trac.versioncontrol.api import Repository, NoSuchChangeset
+from trac.test import EnvironmentStub, Mock
+
+# The updater only reads these attributes of a changeset
+MockChangeset = namedtuple('MockChangeset', 'repos rev message author date')
+
+# Date of the changesets created by the tests
+changeset_date = datetime(2001, 1, 1, tzinfo=utc)
 
 class MockRepository(Repository):
 
     has_linear_changesets = True
 
+    def __init__(self, name, params, log):
+        Repository.__init__(self, name, params, log)
+        # Changesets are created once per revision and repository
+        self._changesets = {}
+
     def get_youngest_rev(self):
         return 100
 
@@ -33,14 +39,18 @@ class MockRepository(Repository):
     def normalize_rev(self, rev):
         if rev is None or rev == '':
             return self.youngest_rev
-        try:
+        if isinstance(rev, int):
+            nrev = rev
+        elif ('%s' % rev).isdigit():
             nrev = int(rev)
-        except:
-            raise NoSuchChangeset(rev)
         else:
-            if not (1 <= nrev <= self.youngest_rev):
-                raise NoSuchChangeset(rev)
-            return nrev
+            raise NoSuchChangeset(rev)
+        if not (1 <= nrev <= self.youngest_rev):
+            raise NoSuchChangeset(rev)
+        return nrev
+
+    def display_rev(self, rev):
+        return rev
 
     def get_node(self, path, rev):
         assert rev % 3 == 1  # allow only 3n + 1
@@ -48,10 +58,16 @@ class MockRepository(Repository):
         return MockNode(self, path, rev, Node.FILE)
 
     def get_changeset(self, rev):
+        rev = self.normalize_rev(rev)
         assert rev % 3 == 1  # allow only 3n + 1
-        return MockChangeset(self, rev, 'message-%d' % rev, 'author-%d' % rev,
-                             datetime(2001, 1, 1, tzinfo=utc) +
-                             timedelta(seconds=rev))
+        changeset = self._changesets.get(rev)
+        if changeset is None:
+            changeset = MockChangeset(self, rev, 'message-%d' % rev,
+                                      'author-%d' % rev,
+                                      changeset_date +
+                                      timedelta(seconds=rev))
+            self._changesets[rev] = changeset
+        return changeset
 
     def previous_rev(self, rev, path=''):
         return rev - 1 if rev > 0 else None
@@ -71,333 +87,270 @@ class MockRepository(Repository):
 
 class test_commitupdater(unittest.TestCase):
 
-
-    def _test_authenticated_session(self, username, fullname, email):
-        """
-        Verifies that a session cookie does not get used if the user is logged
-        in, and that Trac expires the cookie.
-        """
-        req = MockRequest(self.env, authname=username)
-        req.incookie['trac_session'] = '123456'
-        session = Session(self.env, req)
-        self.assertEqual(username, session.sid)
-        session['email'] = email
-        session['name'] = fullname
-        session.save()
-
-    def setUp(self):
-        self.env = \
-            EnvironmentStub(enable=['trac.attachment.LegacyAttachmentPolicy',
-                                    'trac.perm.*',
-                                    'trac.wiki.web_ui.ReadonlyWikiPolicy',
-                                    'trac.ticket.*'])
-        self.policy = ReadonlyWikiPolicy(self.env)
-        store = perm.DefaultPermissionStore(self.env)
-
-
-        self.perm_sys = perm.PermissionSystem(self.env)
-        users = [('user1', 'User C', 'user1@example.org'),
-                               ('user2', 'User A', 'user2@example.org'),
-                               ('user3', 'User D', 'user3@example.org'),
-                               ('user4', 'User B', 'user4@example.org')]
-        self.env.insert_users(users)
-        store.grant_permission('user1', 'TICKET_MODIFY')
-        store.grant_permission('user2', 'TICKET_VIEW')
-        store.grant_permission('user3', 'TICKET_MODIFY')
-        store.grant_permission('user4', 'TICKET_MODIFY')
-
-        for (username, fullname, email) in users:
-            self._test_authenticated_session(username, fullname, email)
-
-        self.repo = Mock(MockRepository, 'testrepo',
+    users = [('user1', 'User C', 'user1@example.org'),
+             ('user2', 'User A', 'user2@example.org'),
+             ('user3', 'User D', 'user3@example.org')]
+
+    @classmethod
+    def setUpClass(cls):
+        # The environment, users, permissions and tickets are shared by all
+        # tests, tearDown only undoes what a single test changes.
+        # EnvironmentStub uses an in-memory SQLite database unless
+        # TRAC_TEST_DB_URI is set, and turns off synchronous writes for an
+        # SQLite file given there.
+        cls.env = EnvironmentStub(enable=['trac.perm.*', 'trac.ticket.*'])
+        cls.env.config.set('trac', 'permission_policies',
+                           'DefaultPermissionPolicy')
+        cls.perm_sys = perm.PermissionSystem(cls.env)
+
+        with cls.env.db_transaction as db:
+            cls._insert_users(cls.users)
+            db.executemany("INSERT INTO permission VALUES (%s,%s)",
+                           [('user1', 'TICKET_MODIFY'),
+                            ('user2', 'TICKET_VIEW')])
+            cls._add_component('component3', 'user3')
+
+            resolution = Resolution(cls.env)
+            resolution.name = 'already_implemented'
+            resolution.insert()
+
+            # The tickets are shared as well, tearDown restores the fields
+            # the commands change
+            ticket = Ticket(cls.env)
+            ticket.populate({
+                'reporter': 'user1',
+                'summary': 'the summary',
+                'component': 'component3',
+                'owner': 'user3',
+                'status': 'new',
+            })
+            cls.tkt_id = ticket.insert()
+
+            ticket2 = Ticket(cls.env)
+            ticket2.populate({
+                'reporter': 'user2',
+                'summary': 'the summary',
+                'component': 'component3',
+                'owner': 'user2',
+                'status': 'new',
+            })
+            cls.tkt2_id = ticket2.insert()
+
+        # The message most tests commit
+        cls.closes_message = "Fixed some stuff. closes #%i" % cls.tkt_id
+
+        cls.repo = Mock(MockRepository, 'testrepo',
                     {'name': 'testrepo', 'id': 4321}, None)
 
-        # Set all component objects to defaults
-        config = self.env.config
-        config.set("ticket","commit_ticket_update_commands.close","close closed closes fix fixed fixes")
-        config.set("ticket","commit_ticket_update_commands.implements","implement implements implemented impl")
-        config.set("ticket","commit_ticket_update_commands.invalidate","invalid invalidate invalidated invalidates")
-        config.set("ticket","commit_ticket_update_commands.refs","addresses re references refs see")
-        config.set("ticket","commit_ticket_update_commands.rejects","reject rejects rejected")
-        config.set("ticket","commit_ticket_update_commands.worksforme","worksforme")
-        config.set("ticket","commit_ticket_update_commands.alreadyimplemented","alreadyimplemented already_implemented")
-        config.set("ticket","commit_ticket_update_commands.reopen","reopen reopens reopened")
-        config.set("ticket","commit_ticket_update_commands.testready","testready test_ready ready_for_test rft")
-        config.set("ticket","commit_ticket_update_allowed_domains","example.org mydomain.net")
-        #config.set("ticket","commit_ticket_update_check_perms",False)
-
-        self._add_component('component3', 'user3')
-
-        self.ticket = Ticket(self.env)
-        self.ticket.populate({
-            'reporter': 'user1',
-            'summary': 'the summary',
-            'component': 'component3',
-            'owner': 'user3',
-            'status': 'new',
-        })
-        self.tkt_id = self.ticket.insert()
-
-        self.ticket2 = Ticket(self.env)
-        self.ticket2.populate({
-            'reporter': 'user2',
-            'summary': 'the summary',
-            'component': 'component3',
-            'owner': 'user2',
-            'status': 'new',
-        })
-        self.tkt2_id = self.ticket2.insert()
-
-        #for username, name, email in self.env.get_known_users():
-         #   sys.stderr.write('known user %s, %s, %s\n' % (username, name, email))
-
-        with self.env.db_transaction as db:
-            db("INSERT INTO enum VALUES ('resolution', 'already_implemented', 6)")
-            #db("INSERT INTO enum VALUES ('resolution', 'worksforme', 5)")
-
-        self._committicketupdater = CommitTicketUpdater(self.env)
+        cls._configure(cls.env.config)
+        cls._committicketupdater = CommitTicketUpdater(cls.env)
+        # Prime the pattern cache: the command pattern compiled here is
+        # reused by every test that keeps the default commands.
+        cls._committicketupdater.command_re
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.env.reset_db()
+
+    # Set all component objects to defaults
+    options = [
+        ("ticket","commit_ticket_update_commands.close","close closed closes fix fixed fixes"),
+        ("ticket","commit_ticket_update_commands.implements","implement implements implemented impl"),
+        ("ticket","commit_ticket_update_commands.invalidate","invalid invalidate invalidated invalidates"),
+        ("ticket","commit_ticket_update_commands.refs","addresses re references refs see"),
+        ("ticket","commit_ticket_update_commands.rejects","reject rejects rejected"),
+        ("ticket","commit_ticket_update_commands.worksforme","worksforme"),
+        ("ticket","commit_ticket_update_commands.alreadyimplemented","alreadyimplemented already_implemented"),
+        ("ticket","commit_ticket_update_commands.reopen","reopen reopens reopened"),
+        ("ticket","commit_ticket_update_commands.testready","testready test_ready ready_for_test rft"),
+        ("ticket","commit_ticket_update_allowed_domains","example.org mydomain.net"),
+        ("ticket","commit_ticket_update_envelope",""),
+        #("ticket","commit_ticket_update_check_perms",False),
+        # The macro tests check the plain changeset message
+        ("changeset","wiki_format_messages","false"),
+    ]
+
+    @classmethod
+    def _configure(cls, config):
+        # The configuration of the stub is never saved, so only the values
+        # a test has changed need to be set again.
+        for section, name, value in cls.options:
+            if config.get(section, name) != value:
+                config.set(section, name, value)
 
     def noop(self):
         pass
 
 
     def tearDown(self):
-        self.env.reset_db()
-
-    def _add_component(self, name='test', owner='owner1'):
-        component = Component(self.env)
+        # Trac commits at the end of each db_transaction, which would also
+        # release a savepoint taken in setUp, so the changes of the test
+        # are undone instead.
+        with self.env.db_transaction:
+            self._reset_ticket(self.tkt_id, 'user3')
+            self._reset_ticket(self.tkt2_id, 'user2')
+        self._configure(self.env.config)
+        # Do not let a test see the changeset of the previous one as a
+        # duplicate
+        self._committicketupdater._last_cset_id = None
+
+    @classmethod
+    def _insert_users(cls, users):
+        # Same as EnvironmentStub.insert_users, but with one statement per
+        # table instead of three per user
+        last_visit = to_timestamp(changeset_date)
+        attributes = []
+        for username, name, email in users:
+            attributes.append((username, 1, 'name', name))
+            attributes.append((username, 1, 'email', email))
+        with cls.env.db_transaction as db:
+            db.executemany("INSERT INTO session VALUES (%s,%s,%s)",
+                           [(username, 1, last_visit)
+                            for username, name, email in users])
+            db.executemany("INSERT INTO session_attribute "
+                           "VALUES (%s,%s,%s,%s)", attributes)
+
+    @classmethod
+    def _add_component(cls, name='test', owner='owner1'):
+        component = Component(cls.env)
         component.name = name
         component.owner = owner
         component.insert()
 
-    def build_comment(self,changeset):
-        revstring = str(changeset.rev)
-        drev = str(self.repo.display_rev(changeset.rev))
-        if self.repo.name:
-            revstring += '/' + self.repo.name
-            drev += '/' + self.repo.name
-
-        return """In [changeset:"%s" %s]:
+    # Ticket comment for a changeset of _mk_cs, i.e. revision 42 of the
+    # test repository
+    comment_template = """In [changeset:"42/testrepo" 42/testrepo]:
 {{{
-#!CommitTicketReference repository="%s" revision="%s"
+#!CommitTicketReference repository="testrepo" revision="42"
 %s
-}}}""" % (revstring, drev, self.repo.name, changeset.rev, changeset.message)
-
-    def check_ticket_comment(self,changeset):
-        for obj in [self.env]:
-            #print('comment=%s' % self.build_comment(changeset), file=sys.stderr)
-            self.assertEqual(self._committicketupdater.make_ticket_comment(self.repo,changeset), self.build_comment(changeset))
-
-    def test_check_closes(self):
-        message = "Fixed some stuff. closes #%i" % self.tkt_id
-        test_changeset = Mock(Changeset, self.repo, 42, message,
-                         'user1@example.org', None)
-        self.check_ticket_comment(test_changeset)
-        # For each object in turn:
-        # Get tickets and commands
-        tickets = self._committicketupdater._parse_message(message)
-        # First, check we've got the tickets we were expecting
-        self.assertEqual(tickets.keys(),[self.tkt_id])
-        # Now check the actions are right
-        self.assertEqual(tickets.get(self.tkt_id),[self._committicketupdater.cmd_close])
-
-        ret = ret = self._committicketupdater.changeset_added_impl(self.repo, test_changeset)
-        (cmds, ticket) = ret[self.tkt_id]
-        self.assertEqual(ticket['status'], 'closed')
-        self.assertEqual(ticket['owner'], 'user1')
-        self.assertEqual(ticket['resolution'], 'fixed')
-
-    def test_check_implements(self):
-        message = "Fixed some stuff. implements #%i" % self.tkt_id
-        test_changeset = Mock(Changeset, self.repo, 42, message,
-                         'user1@example.org', None)
-
-        self.check_ticket_comment(test_changeset)
-        # For each object in turn:
-        # Get tickets and commands
-        tickets = self._committicketupdater._parse_message(message)
-        # First, check we've got the tickets we were expecting
-        self.assertEqual(tickets.keys(),[self.tkt_id])
-        # Now check the actions are right
-        self.assertEqual(tickets.get(self.tkt_id),[self._committicketupdater.cmd_implements])
-
-        ret = self._committicketupdater.changeset_added_impl(self.repo, test_changeset)
-        (cmds, ticket) = ret[self.tkt_id]
-        self.assertEqual(ticket['status'], 'implemented')
-        self.assertEqual(ticket['owner'], 'user1')
-
-    def test_check_invalidate(self):
-        message = "Fixed some stuff. invalid #%i" % self.tkt_id
-        test_changeset = Mock(Changeset, self.repo, 42, message,
-                         'user1@example.org', None)
-        self.check_ticket_comment(test_changeset)
-        # For each object in turn:
-        # Get tickets and commands
-        tickets = self._committicketupdater._parse_message(message)
-        # First, check we've got the tickets we were expecting
-        self.assertEqual(tickets.keys(),[self.tkt_id])
-        # Now check the actions are right
-        self.assertEqual(tickets.get(self.tkt_id),[self._committicketupdater.cmd_invalidate])
-
-        ret = self._committicketupdater.changeset_added_impl(self.repo, test_changeset)
-        (cmds, ticket) = ret[self.tkt_id]
-        self.assertEqual(ticket['status'], 'closed')
-        self.assertEqual(ticket['resolution'], 'invalid')
-
-    def test_check_rejects(self):
-        message = "Fixed some stuff. reject #%i" % self.tkt_id
-        test_changeset = Mock(Changeset, self.repo, 42, message,
-                         'user1@example.org', None)
-        self.check_ticket_comment(test_changeset)
-        # For each object in turn:
-        # Get tickets and commands
-        tickets = self._committicketupdater._parse_message(message)
-        # First, check we've got the tickets we were expecting
-        self.assertEqual(tickets.keys(),[self.tkt_id])
-        # Now check the actions are right
-        self.assertEqual(tickets.get(self.tkt_id),[self._committicketupdater.cmd_rejects])
-
-        ret = self._committicketupdater.changeset_added_impl(self.repo, test_changeset)
-        (cmds, ticket) = ret[self.tkt_id]
-        self.assertEqual(ticket['status'], 'rejected')
-
-    def test_check_worksforme(self):
-        message = "Fixed some stuff. worksforme #%i" % self.tkt_id
-        test_changeset = Mock(Changeset, self.repo, 42, message,
-                         'user1@example.org', None)
-        self.check_ticket_comment(test_changeset)
-        # For each object in turn:
-        # Get tickets and commands
-        tickets = self._committicketupdater._parse_message(message)
-        # First, check we've got the tickets we were expecting
-        self.assertEqual(tickets.keys(),[self.tkt_id])
-        # Now check the actions are right
-        self.assertEqual(tickets.get(self.tkt_id),[self._committicketupdater.cmd_worksforme])
-
-        ret = self._committicketupdater.changeset_added_impl(self.repo, test_changeset)
-        (cmds, ticket) = ret[self.tkt_id]
-        self.assertEqual(ticket['status'], 'closed')
-        self.assertEqual(ticket['resolution'], 'worksforme')
-
-    def test_check_alreadyimplemented(self):
-        message = "Fixed some stuff. alreadyimplemented #%i" % self.tkt_id
-        test_changeset = Mock(Changeset, self.repo, 42, message,
-                         'user1@example.org', None)
-        self.check_ticket_comment(test_changeset)
-        # For each object in turn:
-        # Get tickets and commands
-        tickets = self._committicketupdater._parse_message(message)
-        # First, check we've got the tickets we were expecting
-        self.assertEqual(tickets.keys(),[self.tkt_id])
-        # Now check the actions are right
-        self.assertEqual(tickets.get(self.tkt_id),[self._committicketupdater.cmd_alreadyimplemented])
-
-        ret = self._committicketupdater.changeset_added_impl(self.repo, test_changeset)
-        (cmds, ticket) = ret[self.tkt_id]
-        self.assertEqual(ticket['status'], 'closed')
-        self.assertEqual(ticket['resolution'], 'already_implemented')
-
-    def test_check_already_implemented(self):
-        message = "Fixed some stuff. already_implemented #%i" % self.tkt_id
-        test_changeset = Mock(Changeset, self.repo, 42, message,
-                         'user1@example.org', None)
-        self.check_ticket_comment(test_changeset)
-        # For each object in turn:
-        # Get tickets and commands
-        tickets = self._committicketupdater._parse_message(message)
-        # First, check we've got the tickets we were expecting
-        self.assertEqual(tickets.keys(),[self.tkt_id])
-        # Now check the actions are right
-        self.assertEqual(tickets.get(self.tkt_id),[self._committicketupdater.cmd_alreadyimplemented])
-
-        ret = self._committicketupdater.changeset_added_impl(self.repo, test_changeset)
-        (cmds, ticket) = ret[self.tkt_id]
-        self.assertEqual(ticket['status'], 'closed')
-        self.assertEqual(ticket['resolution'], 'already_implemented')
-
-    def test_check_reopens(self):
-        message = "Fixed some stuff. worksforme #%i" % self.tkt_id
-        test_changeset = Mock(Changeset, self.repo, 42, message,
-                         'user1@example.org', None)
-        ret = self._committicketupdater.changeset_added_impl(self.repo, test_changeset)
+}}}"""
 
-        message = "Fixed some stuff. reopen #%i" % self.tkt_id
-        test_changeset = Mock(Changeset, self.repo, 42, message,
-                         'user1@example.org', None)
-        self.check_ticket_comment(test_changeset)
-        # For each object in turn:
-        # Get tickets and commands
-        tickets = self._committicketupdater._parse_message(message)
-        # First, check we've got the tickets we were expecting
-        self.assertEqual(tickets.keys(),[self.tkt_id])
-        # Now check the actions are right
-        self.assertEqual(tickets.get(self.tkt_id),[self._committicketupdater.cmd_reopens])
+    def _mk_cs(self, message, author='user1@example.org'):
+        return MockChangeset(self.repo, 42, message, author, changeset_date)
 
-        ret = self._committicketupdater.changeset_added_impl(self.repo, test_changeset)
-        (cmds, ticket) = ret[self.tkt_id]
-        self.assertEqual(ticket['status'], 'reopened')
+    def check_ticket_comment(self, changeset):
+        self.assertEqual(self._committicketupdater.make_ticket_comment(self.repo, changeset), self.comment_template % changeset.message)
 
-    def test_check_testready(self):
-        message = "Fixed some stuff. ready_for_test #%i" % self.tkt_id
-        test_changeset = Mock(Changeset, self.repo, 42, message,
-                         'user1@example.org', None)
-        self.check_ticket_comment(test_changeset)
-        # For each object in turn:
-        # Get tickets and commands
-        tickets = self._committicketupdater._parse_message(message)
-        # First, check we've got the tickets we were expecting
-        self.assertEqual(tickets.keys(),[self.tkt_id])
-        # Now check the actions are right
-        self.assertEqual(tickets.get(self.tkt_id),[self._committicketupdater.cmd_testready])
+    def test_ticket_comment_default_repository(self):
+        repo = Mock(MockRepository, '', {'name': '', 'id': 1}, None)
+        message = self.closes_message
+        test_changeset = MockChangeset(repo, 42, message,
+                                       'user1@example.org', changeset_date)
+        self.assertEqual(self._committicketupdater.make_ticket_comment(repo, test_changeset),
+                         """In [changeset:"42" 42]:
+{{{
+#!CommitTicketReference repository="" revision="42"
+%s
+}}}""" % message)
+
+    # (status, keyword, command, new status, new resolution, new owner)
+    # of a ticket with the given status after a changeset with
+    # "<keyword> #<ticket>" has been added
+    command_cases = [
+        ('new', 'closes', 'cmd_close', 'closed', 'fixed', 'user1'),
+        ('new', 'implements', 'cmd_implements', 'implemented', None, 'user1'),
+        ('new', 'invalid', 'cmd_invalidate', 'closed', 'invalid', None),
+        ('new', 'reject', 'cmd_rejects', 'rejected', None, None),
+        ('new', 'worksforme', 'cmd_worksforme', 'closed', 'worksforme', None),
+        ('new', 'alreadyimplemented', 'cmd_alreadyimplemented', 'closed', 'already_implemented', None),
+        ('new', 'already_implemented', 'cmd_alreadyimplemented', 'closed', 'already_implemented', None),
+        ('new', 'ready_for_test', 'cmd_testready', 'test_ready', None, None),
+        ('closed', 'reopen', 'cmd_reopens', 'reopened', '', 'user1'),
+    ]
+
+    def _delete_users(self, *usernames):
+        placeholders = ','.join(['%s'] * len(usernames))
+        with self.env.db_transaction as db:
+            for table in ('session', 'session_attribute'):
+                db("DELETE FROM %s WHERE sid IN (%s)"
+                   % (table, placeholders), usernames)
+        self.env.invalidate_known_users_cache()
 
-        ret = self._committicketupdater.changeset_added_impl(self.repo, test_changeset)
-        (cmds, ticket) = ret[self.tkt_id]
-        self.assertEqual(ticket['status'], 'test_ready')
+    def _reset_ticket(self, tkt_id, owner, status='new'):
+        resolution = 'fixed' if status == 'closed' else ''
+        with self.env.db_transaction as db:
+            db("UPDATE ticket SET status=%s, owner=%s, resolution=%s WHERE id=%s",
+               (status, owner, resolution, tkt_id))
+            db("DELETE FROM ticket_change WHERE ticket=%s", (tkt_id,))
+
+    def test_check_commands(self):
+        for old_status, keyword, command, status, resolution, owner in self.command_cases:
+            self._reset_ticket(self.tkt_id, 'user3', old_status)
+            message = "Fixed some stuff. %s #%i" % (keyword, self.tkt_id)
+            test_changeset = self._mk_cs(message)
+            self.check_ticket_comment(test_changeset)
+            # Get tickets and commands
+            tickets = self._committicketupdater._parse_message(message)
+            # First, check we've got the tickets we were expecting
+            self.assertEqual(list(tickets.keys()),[self.tkt_id], keyword)
+            # Now check the actions are right
+            self.assertEqual(tickets.get(self.tkt_id),
+                             [getattr(self._committicketupdater, command)], keyword)
+
+            ret = self._committicketupdater.changeset_added_impl(self.repo, test_changeset, tickets)
+            (cmds, ticket) = ret[self.tkt_id]
+            self.assertEqual(ticket['status'], status, keyword)
+            if resolution is not None:
+                self.assertEqual(ticket['resolution'], resolution, keyword)
+            if owner is not None:
+                self.assertEqual(ticket['owner'], owner, keyword)
 
     def test_allowed_domains(self):
         message = "Fixed some stuff. reopen #%i" % self.tkt_id
 
-        test_changeset_declined = Mock(Changeset, self.repo, 42, message,
-                         "test_person <me@gohome.now>", None)
+        test_changeset_declined = self._mk_cs(message, "test_person <me@gohome.now>")
         self.assertEqual(self._committicketupdater._is_author_allowed(test_changeset_declined.author),False)
 
-        test_changeset_allowed = Mock(Changeset, self.repo, 42, message,
-                         "test_person <me@mydomain.net>", None)
+        test_changeset_allowed = self._mk_cs(message, "test_person <me@mydomain.net>")
         self.assertEqual(self._committicketupdater._is_author_allowed(test_changeset_allowed.author),True)
 
-        test_changeset_no_domain = Mock(Changeset, self.repo, 42, message,
-                         "test_person", None)
+        test_changeset_no_domain = self._mk_cs(message, "test_person")
         self.assertEqual(self._committicketupdater._is_author_allowed(test_changeset_no_domain.author),False)
 
         message = "Fixed some stuff. fixed #%i" % self.tkt_id
-        test_changeset = Mock(Changeset, self.repo, 42, message,
-                         'test_person <me@gohome.now>', None)
+        test_changeset = self._mk_cs(message, 'test_person <me@gohome.now>')
         self.check_ticket_comment(test_changeset)
         # For each object in turn:
         # Get tickets and commands
         tickets = self._committicketupdater._parse_message(message)
         # First, check we've got the tickets we were expecting
-        self.assertEqual(tickets.keys(),[self.tkt_id])
+        self.assertEqual(list(tickets.keys()),[self.tkt_id])
 
-        ret = self._committicketupdater.changeset_added_impl(self.repo, test_changeset)
+        ret = self._committicketupdater.changeset_added_impl(self.repo, test_changeset, tickets)
         (cmds, ticket) = ret[self.tkt_id]
         self.assertEqual(ticket['status'], 'new')
 
+    def test_get_changeset_author(self):
+        get_author = CommitTicketUpdater._get_changeset_author
+        self.assertEqual(get_author("test_person <me@GoHome.now>"), ('test_person', 'me@GoHome.now', 'gohome.now'))
+        self.assertEqual(get_author("test_person@gohome.now"), (None, 'test_person@gohome.now', 'gohome.now'))
+        self.assertEqual(get_author("<me@gohome.now"), ('', 'me@gohome.now', 'gohome.now'))
+        self.assertEqual(get_author("test_person"), (None, None, None))
+        self.assertEqual(get_author("@gohome.now"), (None, None, None))
+
+    def test_allowed_domains_option(self):
+        self.env.config.set("ticket", "commit_ticket_update_allowed_domains", " Example.ORG   other.net ")
+        self.assertEqual(self._committicketupdater._get_allowed_domains(), frozenset(['example.org', 'other.net']))
+        self.assertEqual(self._committicketupdater._is_author_allowed("test_person <me@example.org>"), True)
+        self.assertEqual(self._committicketupdater._is_author_allowed("test_person <me@mydomain.net>"), False)
+
+        self.env.config.set("ticket", "commit_ticket_update_allowed_domains", "")
+        self.assertEqual(self._committicketupdater._is_author_allowed("test_person"), True)
+
     def test_check_closes_multiple(self):
         message = "Fixed some stuff. closes #%i, #%i" % (self.tkt_id, self.tkt2_id)
-        test_changeset = Mock(Changeset, self.repo, 42, message,
-                         'user1@example.org', None)
+        test_changeset = self._mk_cs(message)
         self.check_ticket_comment(test_changeset)
         # For each object in turn:
         # Get tickets and commands
         tickets = self._committicketupdater._parse_message(message)
         # First, check we've got the tickets we were expecting
-        self.assertEqual(tickets.keys(),[self.tkt_id, self.tkt2_id])
+        self.assertEqual(list(tickets.keys()),[self.tkt_id, self.tkt2_id])
         # Now check the actions are right
         self.assertEqual(tickets.get(self.tkt_id),[self._committicketupdater.cmd_close])
         self.assertEqual(tickets.get(self.tkt2_id),[self._committicketupdater.cmd_close])
 
-        ret = ret = self._committicketupdater.changeset_added_impl(self.repo, test_changeset)
+        ret = self._committicketupdater.changeset_added_impl(self.repo, test_changeset, tickets)
         (cmds, ticket) = ret[self.tkt_id]
         self.assertEqual(ticket['status'], 'closed')
         self.assertEqual(ticket['owner'], 'user1')
@@ -408,43 +361,214 @@ class test_commitupdater(unittest.TestCase):
         self.assertEqual(ticket2['owner'], 'user1')
         self.assertEqual(ticket2['resolution'], 'fixed')
 
+    def test_check_closes_notifies(self):
+        self.env.config.set("ticket", "commit_ticket_update_notify", "true")
+        events = []
+        notification_system = NotificationSystem(self.env)
+        notification_system.notify = events.append
+        test_changeset = self._mk_cs(self.closes_message)
+        try:
+            self._committicketupdater.changeset_added_impl(self.repo, test_changeset)
+        finally:
+            del notification_system.notify
+        self.assertEqual(len(events), 1)
+        self.assertEqual(events[0].target.id, self.tkt_id)
+        self.assertEqual(events[0].author, 'user1')
+        self.assertEqual(events[0].comment, self.comment_template % self.closes_message)
+
+    def test_check_closes_without_permission(self):
+        message = self.closes_message
+        test_changeset = self._mk_cs(message, 'user2@example.org')
+        ret = self._committicketupdater.changeset_added_impl(self.repo, test_changeset)
+        (cmds, ticket) = ret[self.tkt_id]
+        self.assertEqual(ticket['status'], 'new')
+        self.assertEqual(ticket['owner'], 'user3')
+
     def test_check_closes_non_existing_ticket(self):
         non_existing_ticket_id = 12345
         message = "Fixed some stuff. closes #%i" % non_existing_ticket_id
-        test_changeset = Mock(Changeset, self.repo, 42, message,
-                         'user1@example.org', None)
+        test_changeset = self._mk_cs(message)
         self.check_ticket_comment(test_changeset)
         # For each object in turn:
         # Get tickets and commands
         tickets = self._committicketupdater._parse_message(message)
         # First, check we've got the tickets we were expecting
-        self.assertEqual(tickets.keys(),[non_existing_ticket_id])
+        self.assertEqual(list(tickets.keys()),[non_existing_ticket_id])
         # Now check the actions are right
         self.assertEqual(tickets.get(non_existing_ticket_id),[self._committicketupdater.cmd_close])
 
-        ret = ret = self._committicketupdater.changeset_added_impl(self.repo, test_changeset)
+        ret = self._committicketupdater.changeset_added_impl(self.repo, test_changeset, tickets)
         (cmds, ticket) = ret[non_existing_ticket_id]
         self.assertEqual(ticket, None)
 
     def test_check_closes_with_full_email_addr(self):
-        message = "Fixed some stuff. closes #%i" % (self.tkt_id)
-        test_changeset = Mock(Changeset, self.repo, 42, message,
-                         'User One <user1@example.org>', None)
+        message = self.closes_message
+        test_changeset = self._mk_cs(message, 'User One <user1@example.org>')
         self.check_ticket_comment(test_changeset)
         # For each object in turn:
         # Get tickets and commands
         tickets = self._committicketupdater._parse_message(message)
         # First, check we've got the tickets we were expecting
-        self.assertEqual(tickets.keys(),[self.tkt_id])
+        self.assertEqual(list(tickets.keys()),[self.tkt_id])
         # Now check the actions are right
         self.assertEqual(tickets.get(self.tkt_id),[self._committicketupdater.cmd_close])
 
-        ret = ret = self._committicketupdater.changeset_added_impl(self.repo, test_changeset)
+        ret = self._committicketupdater.changeset_added_impl(self.repo, test_changeset, tickets)
         (cmds, ticket) = ret[self.tkt_id]
         self.assertEqual(ticket['status'], 'closed')
         self.assertEqual(ticket['owner'], 'user1')
         self.assertEqual(ticket['resolution'], 'fixed')
 
+    def test_command_re_cached_per_envelope(self):
+        command_re = self._committicketupdater.command_re
+        self.assertTrue(self._committicketupdater.command_re is command_re)
+
+        self.env.config.set("ticket", "commit_ticket_update_envelope", "[]")
+        enveloped_re = self._committicketupdater.command_re
+        self.assertFalse(enveloped_re is command_re)
+        self.assertTrue(self._committicketupdater.command_re is enveloped_re)
+
+        message = "Fixed some stuff. [closes #%i] refs #%i" % (self.tkt_id, self.tkt2_id)
+        tickets = self._committicketupdater._parse_message(message)
+        self.assertEqual(list(tickets.keys()),[self.tkt_id])
+
+        message = self.closes_message
+        tickets = self._committicketupdater._parse_message(message)
+        self.assertEqual(tickets, {})
+
+    def test_functions_cached_per_options(self):
+        functions = self._committicketupdater._get_functions()
+        self.assertTrue(self._committicketupdater._get_functions() is functions)
+
+        self.env.config.set("ticket", "commit_ticket_update_commands.close", "Finish")
+        functions = self._committicketupdater._get_functions()
+        self.assertEqual(functions.get('finish'), self._committicketupdater.cmd_close)
+        self.assertEqual(functions.get('fixes'), None)
+
+        message = "Fixed some stuff. finish #%i" % self.tkt_id
+        tickets = self._committicketupdater._parse_message(message)
+        self.assertEqual(tickets.get(self.tkt_id),[self._committicketupdater.cmd_close])
+
+    def test_parse_message_without_ticket_reference(self):
+        message = "Fixed some stuff. closes nothing at all"
+        tickets = self._committicketupdater._parse_message(message)
+        self.assertEqual(tickets, {})
+
+    def test_parse_message_only_matches_whole_commands(self):
+        message = "Disclose #%i, foo_fixes #%i" % (self.tkt_id, self.tkt2_id)
+        tickets = self._committicketupdater._parse_message(message)
+        self.assertEqual(tickets, {})
+
+        message = "FIXED #%i" % self.tkt_id
+        tickets = self._committicketupdater._parse_message(message)
+        self.assertEqual(tickets.get(self.tkt_id),[self._committicketupdater.cmd_close])
+
+        # A ticket reference may follow the command without a space
+        message = "Fixesticket:%i, refsissue %i" % (self.tkt_id, self.tkt2_id)
+        tickets = self._committicketupdater._parse_message(message)
+        self.assertEqual(tickets, {self.tkt_id: [self._committicketupdater.cmd_close],
+                                   self.tkt2_id: [self._committicketupdater.cmd_refs]})
+        message = "closesissue #%i" % self.tkt_id
+        tickets = self._committicketupdater._parse_message(message)
+        self.assertEqual(tickets, {})
+
+    def test_parse_message_prefers_longest_command(self):
+        updater = self._committicketupdater
+        for action, cmd in (('impl', updater.cmd_implements),
+                            ('Implemented', updater.cmd_implements),
+                            ('rejected', updater.cmd_rejects),
+                            ('already_implemented', updater.cmd_alreadyimplemented),
+                            ('ready_for_test', updater.cmd_testready)):
+            tickets = updater._parse_message("%s #%i" % (action, self.tkt_id))
+            self.assertEqual(tickets, {self.tkt_id: [cmd]})
+
+        message = "Changed #%i, refs #%i" % (self.tkt_id, self.tkt2_id)
+        tickets = updater._parse_message(message)
+        self.assertEqual(tickets, {self.tkt2_id: [updater.cmd_refs]})
+
+    def test_parse_message_returns_new_dict(self):
+        # changeset_modified removes the old tickets from the result
+        message = self.closes_message
+        tickets = self._committicketupdater._parse_message(message)
+        tickets.pop(self.tkt_id)
+        tickets = self._committicketupdater._parse_message(message)
+        self.assertEqual(list(tickets.keys()),[self.tkt_id])
+        self.assertEqual(type(tickets), dict)
+
+    def test_macro_ticket_ids(self):
+        macro = CommitTicketReferenceMacro(self.env)
+        message = "Fixed some stuff. closes #%i, refs ticket:%i" % (self.tkt_id, self.tkt2_id)
+        self.assertEqual(macro._get_ticket_ids(message),
+                         frozenset([self.tkt_id, self.tkt2_id]))
+        self.assertEqual(macro._get_ticket_ids("no references"), frozenset())
+
+    def test_macro_hint_for_unreferenced_ticket(self):
+        macro = CommitTicketReferenceMacro(self.env)
+        message = "Fixed some stuff. refs #%i" % self.tkt_id
+        for tkt_id, referenced in ((self.tkt_id, True), (self.tkt2_id, False)):
+            resource = Mock(realm='ticket', id=str(tkt_id))
+            formatter = Mock(context=Mock(resource=resource))
+            result = str(macro.expand_macro(formatter, 'CommitTicketReference', message,
+                                            {'repository': 'nonexisting', 'revision': '1'}))
+            self.assertEqual("doesn't reference this ticket" in result, not referenced)
+            self.assertEqual(message in result, referenced)
+
+    def test_is_duplicate(self):
+        message = self.closes_message
+        test_changeset = self._mk_cs(message)
+        self.assertEqual(self._committicketupdater._is_duplicate(test_changeset), False)
+        self.assertEqual(self._committicketupdater._is_duplicate(test_changeset), True)
+
+        test_changeset = MockChangeset(self.repo, 43, message,
+                                       'user1@example.org', changeset_date)
+        self.assertEqual(self._committicketupdater._is_duplicate(test_changeset), False)
+
+    def test_parse_message_duplicate_references(self):
+        message = "Fixed some stuff. closes #%i and #%i, refs #%i" % (self.tkt_id, self.tkt_id, self.tkt_id)
+        tickets = self._committicketupdater._parse_message(message)
+        self.assertEqual(tickets.get(self.tkt_id),[self._committicketupdater.cmd_close,
+                                                   self._committicketupdater.cmd_refs])
+
+    def test_macro_changeset_message_cache(self):
+        macro = CommitTicketReferenceMacro(self.env)
+        macro._changeset_messages[('testrepo', 43)] = ('the message', 43)
+        self.assertEqual(macro._get_changeset_message(self.repo, '43'),
+                         ('the message', 43))
+        # The youngest changeset is looked up again every time
+        message, rev = macro._get_changeset_message(self.repo, None)
+        self.assertEqual(rev, 100)
+        self.assertFalse(('testrepo', 100) in macro._changeset_messages)
+
+        test_changeset = self._mk_cs('the new message')
+        macro.changeset_modified(self.repo, test_changeset, None)
+        self.assertEqual(list(macro._changeset_messages), [])
+
+    def test_username_for_email(self):
+        self.assertEqual(self._committicketupdater._get_username_for_email('User2@Example.org'), 'user2')
+        self.assertEqual(self._committicketupdater._get_username_for_email('user3'), 'user3')
+        self.assertEqual(self._committicketupdater._get_username_for_email('user5@example.org'), None)
+
+        self.addCleanup(self._delete_users, 'user5', 'User6')
+        self._insert_users([('user5', 'User E', 'user5@example.org')])
+        self.env.invalidate_known_users_cache()
+        self.assertEqual(self._committicketupdater._get_username_for_email('user5@example.org'), 'user5')
+
+        self._insert_users([('User6', 'User F', 'User6@Example.ORG')])
+        self.env.invalidate_known_users_cache()
+        self.assertEqual(self._committicketupdater._get_username_for_email('user6@example.org'), 'User6')
+        self.assertEqual(self._committicketupdater._get_username_for_email('USER6'), 'User6')
+
+    def test_changeset_modified_skips_old_tickets(self):
+        old_message = "Fixed some stuff. refs #%i" % self.tkt_id
+        old_changeset = self._mk_cs(old_message)
+        message = "Fixed some stuff. closes #%i, #%i" % (self.tkt_id, self.tkt2_id)
+        test_changeset = self._mk_cs(message)
+
+        self._committicketupdater.changeset_modified(self.repo, test_changeset,
+                                                     old_changeset)
+        self.assertEqual(Ticket(self.env, self.tkt_id)['status'], 'new')
+        self.assertEqual(Ticket(self.env, self.tkt2_id)['status'], 'closed')
+
 if __name__ == '__main__':
     unittest.main()
     #t = test_commitupdater(methodName='noop')